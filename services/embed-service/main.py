@@ -1,24 +1,30 @@
 import asyncio
+import hashlib
 import logging
 import os
 import sys
 import time
 from contextlib import asynccontextmanager
-from typing import List
+from datetime import datetime, timezone
+from typing import Dict, List
 import httpx
+import numpy as np
+import orjson
 import structlog
+from cachetools import TTLCache
 from fastapi import FastAPI, HTTPException, Request, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
-from tenacity import (
-    retry,
-    retry_if_exception_type,
-    stop_after_attempt,
-    wait_exponential,
-)
 from dotenv import load_dotenv
 from sparse_vector_generator import ArabicBM25S
-from models import EmbeddingRequest, EmbeddingResponseModel, HealthResponse, ErrorResponse
+from models import (
+    MAX_TEXT_LENGTH,
+    MAX_TEXTS_PER_REQUEST,
+    EmbeddingRequest,
+    EmbeddingResponseModel,
+    HealthResponse,
+    ErrorResponse,
+)
 
 
 # Import .env file
@@ -29,11 +35,21 @@ load_dotenv()
 class Config:
     DEEPINFRA_API_KEY = os.getenv("DEEPINFRA_API_KEY")
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
-    MAX_TEXTS_PER_REQUEST = int(os.getenv("MAX_TEXTS_PER_REQUEST", "10"))
-    MAX_TEXT_LENGTH = int(os.getenv("MAX_TEXT_LENGTH", "8000"))
+    MAX_TEXTS_PER_REQUEST = MAX_TEXTS_PER_REQUEST
+    MAX_TEXT_LENGTH = MAX_TEXT_LENGTH
     REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "30"))
     EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "BAAI/bge-m3-multi")
-    DEEPINFRA_API_URL = f"https://api.deepinfra.com/v1/inference/{os.getenv('EMBEDDING_MODEL', 'BAAI/bge-m3-multi')}"
+    DEEPINFRA_API_URL = f"https://api.deepinfra.com/v1/inference/{EMBEDDING_MODEL}"
+    DEEPINFRA_HEADERS = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {DEEPINFRA_API_KEY}",
+    }
+    DEEPINFRA_BATCH_SIZE = int(os.getenv("DEEPINFRA_BATCH_SIZE", "50"))
+    DEEPINFRA_MAX_BATCH_CHARS = int(os.getenv("DEEPINFRA_MAX_BATCH_CHARS", "120000"))
+    DEEPINFRA_MAX_CONCURRENCY = int(os.getenv("DEEPINFRA_MAX_CONCURRENCY", "8"))
+    BM25_MODEL_PATH = os.getenv("BM25_MODEL_PATH")
+    EMBEDDING_CACHE_MAX_MB = int(os.getenv("EMBEDDING_CACHE_MAX_MB", "256"))
+    EMBEDDING_CACHE_TTL = int(os.getenv("EMBEDDING_CACHE_TTL", "86400"))
 
     @classmethod
     def validate(cls):
@@ -43,9 +59,15 @@ class Config:
 
 
 # Logging setup
+def _orjson_dumps(obj, **kwargs) -> str:
+    """structlog serializer backed by orjson (stdlib logging expects str)"""
+    return orjson.dumps(obj, **kwargs).decode()
+
+
 def setup_logging():
     structlog.configure(
         processors=[
+            structlog.contextvars.merge_contextvars,
             structlog.stdlib.filter_by_level,
             structlog.stdlib.add_logger_name,
             structlog.stdlib.add_log_level,
@@ -53,7 +75,7 @@ def setup_logging():
             structlog.processors.TimeStamper(fmt="iso"),
             structlog.processors.StackInfoRenderer(),
             structlog.processors.format_exc_info,
-            structlog.processors.JSONRenderer(),
+            structlog.processors.JSONRenderer(serializer=_orjson_dumps),
         ],
         context_class=dict,
         logger_factory=structlog.stdlib.LoggerFactory(),
@@ -70,23 +92,51 @@ def setup_logging():
 
 # Global variables
 http_client = None
+bm25_model = None
 logger = structlog.get_logger()
 
+# Caps in-flight DeepInfra calls across all requests to respect the provider rate limit
+deepinfra_semaphore = asyncio.Semaphore(Config.DEEPINFRA_MAX_CONCURRENCY)
+
+# Embedding cache: blake2b(model|text) -> {"dense": ndarray, "colbert": ndarray},
+# bounded by the total size of the cached vectors rather than entry count
+embedding_cache = TTLCache(
+    maxsize=Config.EMBEDDING_CACHE_MAX_MB * 1024 * 1024,
+    ttl=Config.EMBEDDING_CACHE_TTL,
+    getsizeof=lambda entry: sum(vector.nbytes for vector in entry.values()),
+)
+
 
 # Application lifecycle
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Startup and shutdown events"""
-    global http_client
+    global http_client, bm25_model
 
     # Startup
     try:
         logger.info("Starting Embedding Service")
         Config.validate()
 
-        # Initialize HTTP client with timeout
+        # Initialize a pooled HTTP/2 client shared by all DeepInfra calls
         timeout = httpx.Timeout(Config.REQUEST_TIMEOUT)
-        http_client = httpx.AsyncClient(timeout=timeout)
+        http_client = httpx.AsyncClient(
+            timeout=timeout,
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+            headers=Config.DEEPINFRA_HEADERS,
+        )
+
+        # Load the BM25 model fitted offline on the indexed corpus
+        if Config.BM25_MODEL_PATH:
+            bm25_model = await asyncio.to_thread(ArabicBM25S.load, Config.BM25_MODEL_PATH)
+            logger.info(
+                "BM25 model loaded",
+                path=Config.BM25_MODEL_PATH,
+                vocab_size=bm25_model.vocab_size,
+            )
+        else:
+            logger.warning("BM25_MODEL_PATH not set, fitting BM25 per request")
 
         # Test API connection
         await test_deepinfra_connection()
@@ -103,20 +153,15 @@ async def lifespan(app: FastAPI):
         if http_client:
             await http_client.aclose()
         http_client = None
+        bm25_model = None
 
 
 async def test_deepinfra_connection():
     """Test DeepInfra API connection during startup"""
     try:
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {Config.DEEPINFRA_API_KEY}",
-        }
         payload = {"inputs": ["test"], "dense": True, "sparse": False, "colbert": False}
 
-        response = await http_client.post(
-            Config.DEEPINFRA_API_URL, headers=headers, json=payload
-        )
+        response = await http_client.post(Config.DEEPINFRA_API_URL, json=payload)
 
         if response.status_code == 200:
             logger.info("DeepInfra API connection verified")
@@ -154,38 +199,45 @@ app.add_middleware(
 )
 
 
+# Liveness/readiness probes are polled constantly; keep them out of the request log
+UNLOGGED_PATHS = frozenset({"/health", "/ready"})
+
+
 @app.middleware("http")
 async def logging_middleware(request: Request, call_next):
     """Request/response logging and timing"""
-    if request.url.path in ("/health", "/ready"):
+    if request.url.path in UNLOGGED_PATHS:
         return await call_next(request)
 
-    request_id = request.headers.get("x-request-id", f"req_{int(time.time() * 1000)}")
-    start_time = time.time()
+    request_id = request.headers.get("x-request-id", f"req_{time.time_ns() // 1_000_000}")
+    start_time = time.perf_counter()
 
-    logger.info(
-        "Request started",
+    # Bind request context once; every log line emitted while handling it inherits it
+    structlog.contextvars.clear_contextvars()
+    structlog.contextvars.bind_contextvars(
+        request_id=request_id,
         method=request.method,
         path=request.url.path,
-        request_id=request_id,
     )
 
     response = await call_next(request)
 
-    duration = time.time() - start_time
+    duration_ms = int((time.perf_counter() - start_time) * 1000)
     logger.info(
         "Request completed",
-        method=request.method,
-        path=request.url.path,
         status_code=response.status_code,
-        duration=f"{duration:.3f}s",
-        request_id=request_id,
+        duration_ms=duration_ms,
     )
 
     response.headers["x-request-id"] = request_id
     return response
 
 
+def _utc_now_iso() -> str:
+    """UTC timestamp for response bodies, in the same ISO format as the logs"""
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
 # Error handlers
 @app.exception_handler(ValueError)
 async def value_error_handler(request: Request, exc: ValueError):
@@ -195,7 +247,7 @@ async def value_error_handler(request: Request, exc: ValueError):
         content=ErrorResponse(
             error=str(exc),
             request_id=request_id,
-            timestamp=time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime()),
+            timestamp=_utc_now_iso(),
         ).model_dump(),
     )
 
@@ -210,54 +262,162 @@ async def general_exception_handler(request: Request, exc: Exception):
         content=ErrorResponse(
             error="Internal server error",
             request_id=request_id,
-            timestamp=time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime()),
+            timestamp=_utc_now_iso(),
         ).model_dump(),
     )
 
 
-# Retry logic for DeepInfra API calls
-@retry(
-    retry=retry_if_exception_type((httpx.TimeoutException, httpx.HTTPStatusError)),
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(multiplier=1, min=4, max=10),
-    reraise=True,
-)
+# Retry policy for DeepInfra API calls
+DEEPINFRA_MAX_ATTEMPTS = 3
+
+
 async def call_deepinfra_api(
     input_texts: List[str], dense: bool, sparse: bool, colbert: bool
 ) -> dict:
-    """Call DeepInfra API with retry logic"""
-    try:
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {Config.DEEPINFRA_API_KEY}",
-        }
-        payload = {
+    """Call DeepInfra API, retrying timeouts and HTTP errors with exponential backoff"""
+    payload = orjson.dumps(
+        {
             "inputs": input_texts,
             "dense": dense,
             "sparse": sparse,
             "colbert": colbert,
         }
+    )
 
-        response = await http_client.post(
-            Config.DEEPINFRA_API_URL, headers=headers, json=payload
-        )
+    for attempt in range(DEEPINFRA_MAX_ATTEMPTS):
+        try:
+            response = await http_client.post(Config.DEEPINFRA_API_URL, content=payload)
 
-        if response.status_code != 200:
+            if response.status_code != 200:
+                logger.error(
+                    "DeepInfra API error",
+                    status_code=response.status_code,
+                    response=response.text,
+                )
+                response.raise_for_status()
+
+            return orjson.loads(response.content)
+
+        except (httpx.TimeoutException, httpx.HTTPStatusError) as e:
             logger.error(
-                "DeepInfra API error",
-                status_code=response.status_code,
-                response=response.text,
+                "DeepInfra API timeout"
+                if isinstance(e, httpx.TimeoutException)
+                else "DeepInfra API call failed",
+                error=str(e),
+                attempt=attempt + 1,
             )
-            response.raise_for_status()
+            if attempt == DEEPINFRA_MAX_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(min(4 * 2**attempt, 10))
+        except Exception as e:
+            logger.error("DeepInfra API call failed", error=str(e))
+            raise
+
+
+def _cache_key(text: str) -> bytes:
+    return hashlib.blake2b(
+        f"{Config.EMBEDDING_MODEL}|{text}".encode(), digest_size=16
+    ).digest()
+
+
+def _pack_batches(input_texts: List[str]) -> List[List[str]]:
+    """Greedily pack texts into batches bounded by text count and total characters"""
+    batches: List[List[str]] = []
+    batch: List[str] = []
+    batch_chars = 0
+    for text in input_texts:
+        if batch and (
+            len(batch) >= Config.DEEPINFRA_BATCH_SIZE
+            or batch_chars + len(text) > Config.DEEPINFRA_MAX_BATCH_CHARS
+        ):
+            batches.append(batch)
+            batch, batch_chars = [], 0
+        batch.append(text)
+        batch_chars += len(text)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+async def call_deepinfra_batches(
+    input_texts: List[str], dense: bool, colbert: bool
+) -> dict:
+    """Split texts into batches and embed them concurrently, preserving input order"""
 
-        return response.json()
+    async def do_batch(batch: List[str]) -> dict:
+        async with deepinfra_semaphore:
+            return await call_deepinfra_api(batch, dense, False, colbert)
 
-    except httpx.TimeoutException as e:
-        logger.error("DeepInfra API timeout", error=str(e))
-        raise
-    except Exception as e:
-        logger.error("DeepInfra API call failed", error=str(e))
-        raise
+    raw_responses = await asyncio.gather(
+        *(do_batch(batch) for batch in _pack_batches(input_texts))
+    )
+
+    merged = {}
+    if dense:
+        merged["embeddings"] = [v for raw in raw_responses for v in raw["embeddings"]]
+    if colbert:
+        merged["colbert"] = [v for raw in raw_responses for v in raw["colbert"]]
+    return merged
+
+
+async def embed_texts(input_texts: List[str], dense: bool, colbert: bool) -> dict:
+    """Embed texts via DeepInfra, serving previously embedded texts from the cache"""
+    needed = [name for name, wanted in (("dense", dense), ("colbert", colbert)) if wanted]
+
+    # Deduplicate the batch; positions maps each input back to its unique text
+    unique: Dict[str, int] = {}
+    positions = [unique.setdefault(text, len(unique)) for text in input_texts]
+    unique_texts = list(unique)
+
+    keys = [_cache_key(text) for text in unique_texts]
+    entries = [embedding_cache.get(key) for key in keys]
+
+    misses = [
+        i
+        for i, entry in enumerate(entries)
+        if entry is None or any(name not in entry for name in needed)
+    ]
+    if misses:
+        raw_response = await call_deepinfra_batches(
+            [unique_texts[i] for i in misses], dense, colbert
+        )
+        for j, i in enumerate(misses):
+            entry = dict(entries[i] or {})
+            if dense:
+                entry["dense"] = np.asarray(raw_response["embeddings"][j], dtype=np.float64)
+            if colbert:
+                entry["colbert"] = np.asarray(raw_response["colbert"][j], dtype=np.float64)
+            entries[i] = entry
+            if embedding_cache.getsizeof(entry) <= embedding_cache.maxsize:
+                embedding_cache[keys[i]] = entry
+
+    logger.debug(
+        "Embedding cache lookup",
+        unique=len(unique_texts),
+        hits=len(unique_texts) - len(misses),
+        misses=len(misses),
+    )
+
+    result = {}
+    if dense:
+        result["embeddings"] = [entries[p]["dense"].tolist() for p in positions]
+    if colbert:
+        result["colbert"] = [entries[p]["colbert"].tolist() for p in positions]
+    return result
+
+
+async def _noop() -> None:
+    return None
+
+
+def _bm25_encode(input_texts: List[str]) -> List[dict]:
+    """Encode texts as BM25 sparse vectors (CPU-bound, run off the event loop)"""
+    bm25 = bm25_model
+    if bm25 is None:
+        bm25 = ArabicBM25S().fit(input_texts)
+    # encode_queries only reads the fitted model, so sharing it across threads is safe
+    sparse_vectors = bm25.encode_queries(input_texts)
+    return [sv.to_milvus() for sv in sparse_vectors]
 
 
 @app.get("/health", response_model=HealthResponse)
@@ -265,7 +425,7 @@ async def health_check():
     """Health check endpoint"""
     return HealthResponse(
         status="healthy",
-        timestamp=time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime()),
+        timestamp=_utc_now_iso(),
     )
 
 
@@ -282,7 +442,7 @@ async def readiness_check():
 
         return HealthResponse(
             status="ready",
-            timestamp=time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime()),
+            timestamp=_utc_now_iso(),
         )
     except Exception as e:
         logger.error("Readiness check failed", error=str(e))
@@ -310,7 +470,7 @@ async def get_embedding(request: EmbeddingRequest, http_request: Request):
     timeouts, and retry logic.
     """
     request_id = http_request.headers.get(
-        "x-request-id", f"req_{int(time.time() * 1000)}"
+        "x-request-id", f"req_{time.time_ns() // 1_000_000}"
     )
 
     try:
@@ -329,23 +489,19 @@ async def get_embedding(request: EmbeddingRequest, http_request: Request):
             request_id=request_id,
         )
 
-        # Call DeepInfra API only when dense or colbert embeddings are needed
-        raw_response = None
-        if request.dense or request.colbert:
-            raw_response = await call_deepinfra_api(
-                request.input_text, request.dense, False, request.colbert
-            )
+        # DeepInfra is called only for dense/colbert; BM25 runs in a thread meanwhile,
+        # so mixed requests take max(network, bm25) rather than their sum
+        raw_response, sparse_embeddings = await asyncio.gather(
+            embed_texts(request.input_text, request.dense, request.colbert)
+            if request.dense or request.colbert
+            else _noop(),
+            asyncio.to_thread(_bm25_encode, request.input_text)
+            if request.sparse
+            else _noop(),
+        )
 
         # Process response
         dense_embeddings = raw_response.get("embeddings", []) if request.dense and raw_response else None
-        sparse_embeddings = None
-        if request.sparse:
-            def _compute_sparse():
-                bm25 = ArabicBM25S()
-                bm25.fit(request.input_text)
-                sparse_vectors = bm25.encode_queries(request.input_text)
-                return [sv.to_milvus() for sv in sparse_vectors]
-            sparse_embeddings = await asyncio.to_thread(_compute_sparse)
         colbert_embeddings = (
             raw_response.get("colbert", []) if request.colbert and raw_response else None
         )
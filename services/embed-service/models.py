@@ -1,14 +1,19 @@
+import os
 from typing import List, Optional
+from dotenv import load_dotenv
 from pydantic import BaseModel, Field, field_validator
 
 
-# Import Config at module level to avoid circular import issues
-MAX_TEXT_LENGTH = 8000
+# Request limits are read here (main.Config re-exports them) so the validators
+# and the service config share one source without a circular import
+load_dotenv()
+MAX_TEXTS_PER_REQUEST = int(os.getenv("MAX_TEXTS_PER_REQUEST", "10"))
+MAX_TEXT_LENGTH = int(os.getenv("MAX_TEXT_LENGTH", "8000"))
 
 
 class EmbeddingRequest(BaseModel):
     input_text: List[str] = Field(
-        ..., min_items=1, max_items=10
+        ..., min_items=1, max_items=MAX_TEXTS_PER_REQUEST
     )
     dense: bool = True
     sparse: bool = False
@@ -20,12 +25,14 @@ class EmbeddingRequest(BaseModel):
         # Filter out empty texts and validate length
         valid_texts = []
         for text in v:
-            if text.strip():
-                if len(text) > MAX_TEXT_LENGTH:
-                    raise ValueError(
-                        f"Text exceeds maximum length of {MAX_TEXT_LENGTH} characters"
-                    )
-                valid_texts.append(text.strip())
+            stripped = text.strip()
+            if not stripped:
+                continue
+            if len(stripped) > MAX_TEXT_LENGTH:
+                raise ValueError(
+                    f"Text exceeds maximum length of {MAX_TEXT_LENGTH} characters"
+                )
+            valid_texts.append(stripped)
 
         if not valid_texts:
             raise ValueError("At least one non-empty text is required")